@@ -1,14 +1,21 @@
+import codecs
+import functools
+import hashlib
+import io
 import re
-import tempfile
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
 import streamlit as st
-from PIL import Image, ImageOps, ImageEnhance
+from PIL import Image, ImageEnhance
 from fpdf import FPDF
+from fpdf.enums import XPos, YPos
 
 from agno.agent import Agent
 from agno.models.google import Gemini
 from agno.media import Image as AgnoImage
+from agno.run.base import RunStatus
 
 
 # ---------------- Session State ----------------
@@ -16,6 +23,7 @@ for key, default in [
     ("GOOGLE_API_KEY", None),
     ("pdf_bytes", None),
     ("pdf_filename", None),
+    ("analysis_cache", {}),
 ]:
     if key not in st.session_state:
         st.session_state[key] = default
@@ -53,86 +61,138 @@ if not medical_agent:
 
 
 # ---------------- Utilities ----------------
+PDF_IMAGE_DPI = 200
+PDF_EPW_MM = FPDF(unit="mm", format="A4").epw  # printable width of a default A4 page
+
+_BULLET_RE = re.compile(r"^[-*]\s+")
+# One line plus its terminator, or a trailing unterminated line
+_LINE_RE = re.compile(r"[^\r\n]*(?:\r\n?|\n)|[^\r\n]+")
+
+# Heading level (number of leading '#') -> font size
+_HEADING_SIZES = (None, 16, 14, 12, 11)
+
+_SANITIZE_TABLE = str.maketrans({
+    "\u2013": "-",  # en dash
+    "\u2014": "-",  # em dash
+    "\u2212": "-",  # minus sign
+    "\u2022": "-",  # bullet
+    "\u00B7": "-",  # middle dot
+    "\u00A0": " ",  # non-breaking space
+})
+
+
+def _latin1_fallback(err: UnicodeEncodeError):
+    # Degrade characters outside Latin-1 to their base letters (e.g. "ő" -> "o") instead of dropping them
+    bad = err.object[err.start:err.end]
+    return unicodedata.normalize("NFKD", bad).encode("latin-1", "ignore").decode("latin-1"), err.end
+
+
+codecs.register_error("pdf_latin1", _latin1_fallback)
+
+
+def _enhance_lut(img: Image, contrast: float) -> list:
+    # Per-band autocontrast stretch followed by a contrast curve, as one point() table
+    hist = img.histogram()
+    bands, means = [], []
+    for b in range(len(img.getbands())):
+        h = hist[b * 256:(b + 1) * 256]
+        lo = next((i for i, n in enumerate(h) if n), 0)
+        hi = 255 - next((i for i, n in enumerate(reversed(h)) if n), 0)
+        if hi <= lo:
+            band = list(range(256))
+        else:
+            # Same scale/offset form as ImageOps.autocontrast so truncation matches
+            scale = 255.0 / (hi - lo)
+            offset = -lo * scale
+            band = [min(max(int(i * scale + offset), 0), 255) for i in range(256)]
+        bands.append(band)
+        means.append(sum(n * v for n, v in zip(h, band)) / max(sum(h), 1))
+
+    # ImageEnhance.Contrast pivots on the mean grey level of the image and
+    # Image.blend truncates, so the contrast step truncates too. The mean is
+    # taken from the band histograms rather than a per-pixel convert("L"), so
+    # it can land one level off Pillow's pivot in rare cases
+    if len(means) == 3:
+        pivot = 0.299 * means[0] + 0.587 * means[1] + 0.114 * means[2]
+    else:
+        pivot = sum(means) / max(len(means), 1)
+    pivot = int(pivot + 0.5)
+
+    lut = []
+    for band in bands:
+        lut.extend(min(max(int(pivot + (v - pivot) * contrast), 0), 255) for v in band)
+    return lut
+
+
 def enhance_image(img: Image) -> Image:
     # Lightweight enhancement (no OpenCV)
-    img = ImageOps.autocontrast(img)
+    img = img.point(_enhance_lut(img, 1.05))
     img = ImageEnhance.Sharpness(img).enhance(1.2)
-    img = ImageEnhance.Contrast(img).enhance(1.05)
     return img
 
 
+# Uploads are full-resolution patient images shared across sessions: keep few, briefly
+IMAGE_CACHE_ENTRIES = 4
+IMAGE_CACHE_TTL = 600  # seconds
+
+
+@st.cache_data(show_spinner=False, max_entries=IMAGE_CACHE_ENTRIES, ttl=IMAGE_CACHE_TTL)
+def load_image(raw_bytes: bytes) -> Image:
+    return Image.open(io.BytesIO(raw_bytes)).convert("RGB")
+
+
+@st.cache_data(show_spinner=False, max_entries=IMAGE_CACHE_ENTRIES, ttl=IMAGE_CACHE_TTL)
+def load_enhanced_image(raw_bytes: bytes) -> Image:
+    # Cached per upload so widget reruns don't re-enhance the same image
+    return enhance_image(load_image(raw_bytes))
+
+
+@functools.lru_cache(maxsize=2048)
 def sanitize_text(text: str) -> str:
     if not text:
         return ""
     t = str(text)
-    replacements = {
-        "\u2013": "-",  # en dash
-        "\u2014": "-",  # em dash
-        "\u2212": "-",  # minus sign
-        "\u2022": "-",  # bullet
-        "\u00B7": "-",  # middle dot
-        "\u00A0": " ",  # non-breaking space
-    }
-    for k, v in replacements.items():
-        t = t.replace(k, v)
+    # Plain ASCII needs no replacement or re-encoding
+    if t.isascii():
+        return t
     # Remove emojis / non-Latin-1 (fpdf Core fonts)
-    t = t.encode("latin-1", "ignore").decode("latin-1")
-    return t
+    return t.translate(_SANITIZE_TABLE).encode("latin-1", "pdf_latin1").decode("latin-1")
+
 
+@functools.lru_cache(maxsize=None)
+def _long_token_re(max_len: int) -> re.Pattern:
+    return re.compile(r"[^ ]{%d,}" % (max_len + 1))
 
+
+@functools.lru_cache(maxsize=2048)
 def soft_wrap_tokens(text: str, max_len: int = 60) -> str:
     # Split very long tokens so MultiCell can wrap
-    out = []
-    for tok in str(text).split(" "):
-        if len(tok) <= max_len:
-            out.append(tok)
-        else:
-            chunks = [tok[i:i + max_len] for i in range(0, len(tok), max_len)]
-            out.append("\n".join(chunks))
-    return " ".join(out)
+    text = str(text)
+    if len(text) <= max_len:
+        return text
 
+    def split_token(m: re.Match) -> str:
+        tok = m.group(0)
+        return "\n".join(tok[i:i + max_len] for i in range(0, len(tok), max_len))
 
-def build_pdf_from_markdown(patient_info: dict, markdown_text: str, image_path: str) -> bytes:
-    def render_md_line(pdf: FPDF, epw: float, line_h: float, raw: str):
-        s = sanitize_text(raw.rstrip())
-        if not s.strip():
-            pdf.ln(2)
-            return
+    return _long_token_re(max_len).sub(split_token, text)
+
+
+def fit_pdf_image(img: Image, width_mm: float = PDF_EPW_MM) -> Image:
+    # Downsample to the printed width so the PDF doesn't embed every source pixel
+    target_px_w = int(width_mm / 25.4 * PDF_IMAGE_DPI)
+    if img.width <= target_px_w:
+        return img
+    target_px_h = max(int(target_px_w * img.height / img.width), 1)
+    return img.resize((target_px_w, target_px_h), Image.LANCZOS)
 
-        # Headings
-        if s.startswith("#### "):
-            pdf.set_font("Helvetica", "B", 11)
-            txt = s[5:].strip()
-        elif s.startswith("### "):
-            pdf.set_font("Helvetica", "B", 12)
-            txt = s[4:].strip()
-        elif s.startswith("## "):
-            pdf.set_font("Helvetica", "B", 14)
-            txt = s[3:].strip()
-        elif s.startswith("# "):
-            pdf.set_font("Helvetica", "B", 16)
-            txt = s[2:].strip()
-        else:
-            # Bullets and ordered lists
-            pdf.set_font("Helvetica", "", 10)
-            if re.match(r"^[-*]\s+", s):
-                # Use hyphen instead of bullet to ensure Latin-1 compatibility
-                txt = "- " + s[2:].strip()
-            elif re.match(r"^\d+[.)]\s+", s):
-                txt = s
-            else:
-                txt = s
-        # Sanitize AFTER list/heading conversion
-        txt = sanitize_text(txt)
-        txt = soft_wrap_tokens(txt, 60)
-        pdf.set_x(pdf.l_margin)
-        pdf.multi_cell(epw, line_h, txt)
 
+def build_pdf_from_markdown(patient_info: dict, markdown_text: str, pil_image: Image) -> bytes:
     pdf = FPDF(unit="mm", format="A4")
     pdf.set_auto_page_break(auto=True, margin=15)
     pdf.add_page()
 
-    epw = pdf.w - pdf.l_margin - pdf.r_margin
+    epw = PDF_EPW_MM
     line_h = 5.5
 
     # Title
@@ -152,22 +212,59 @@ def build_pdf_from_markdown(patient_info: dict, markdown_text: str, image_path:
 
     # Single image (exactly the one shown in UI)
     try:
-        from PIL import Image as PILImage
-        img = PILImage.open(image_path)
         max_w = epw
-        ratio = img.height / max(img.width, 1)
-        img_h = max_w * ratio
+        w, h = pil_image.size
+        img_h = max_w * h / max(w, 1)
+        img = fit_pdf_image(pil_image, max_w)
         if pdf.get_y() + img_h + 8 > pdf.h - pdf.b_margin:
             pdf.add_page()
         pdf.set_x(pdf.l_margin)
-        pdf.image(image_path, x=pdf.l_margin, y=pdf.get_y(), w=max_w)
+        pdf.image(img, x=pdf.l_margin, y=pdf.get_y(), w=max_w)
         pdf.set_xy(pdf.l_margin, pdf.get_y() + img_h + 4)
     except Exception:
         pass
 
-    # Render markdown lines
-    for line in (markdown_text or "").splitlines():
-        render_md_line(pdf, epw, line_h, line)
+    # Render markdown lines; bind the per-line PDF methods once as closure locals
+    set_font, multi_cell, ln = pdf.set_font, pdf.multi_cell, pdf.ln
+    current_font = None
+
+    def use_font(style: str, size: int):
+        # Only touch the PDF font state when the line style actually changes
+        nonlocal current_font
+        if current_font != (style, size):
+            set_font("Helvetica", style, size)
+            current_font = (style, size)
+
+    def render_md_line(raw: str):
+        s = sanitize_text(raw.rstrip())
+        if not s.strip():
+            ln(2)
+            return
+
+        # Dispatch on the first character: headings, bullets
+        c = s[:1]
+        level = len(s) - len(s.lstrip("#")) if c == "#" else 0
+        if 0 < level < len(_HEADING_SIZES) and s[level:level + 1] == " ":
+            use_font("B", _HEADING_SIZES[level])
+            txt = s[level + 1:].strip()
+        else:
+            use_font("", 10)
+            if c in "-*" and _BULLET_RE.match(s):
+                # Use hyphen instead of bullet to ensure Latin-1 compatibility
+                txt = "- " + s[2:].strip()
+            else:
+                # Ordered-list and paragraph lines render as-is
+                txt = s
+        # Sanitize AFTER list/heading conversion
+        txt = sanitize_text(txt)
+        txt = soft_wrap_tokens(txt, 60)
+        # Return to the left margin so consecutive lines need no set_x
+        multi_cell(epw, line_h, txt, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    # Stream lines from the text rather than materializing a list; the
+    # terminator is removed by the rstrip() in render_md_line
+    for m in _LINE_RE.finditer(markdown_text or ""):
+        render_md_line(m.group())
 
     # Footer
     pdf.ln(4)
@@ -177,15 +274,32 @@ def build_pdf_from_markdown(patient_info: dict, markdown_text: str, image_path:
     pdf.multi_cell(epw, 5, "AI-assisted report for educational purposes. Please have a qualified clinician review.")
     pdf.set_text_color(0, 0, 0)
 
-    raw = pdf.output(dest="S")
-    if isinstance(raw, bytes):
-        return raw
-    if isinstance(raw, (bytearray, memoryview)):
-        return bytes(raw)
-    return str(raw).encode("latin-1", errors="ignore")
+    # fpdf2 returns the document buffer as a bytearray
+    return bytes(pdf.output())
 
 
 # ---------------- UI ----------------
+DOWNLOAD_BUTTON_CSS = """
+<style>
+div[data-testid="stDownloadButton"] > button {
+    background: transparent !important;
+    color: #0F6FFF !important;
+    border: 1px solid #0F6FFF !important;
+    border-radius: 6px;
+    padding: 0.5rem 1rem;
+    transition: background-color .2s ease, border-color .2s ease, color .2s ease, transform .05s ease;
+}
+div[data-testid="stDownloadButton"] > button:hover {
+    background: rgba(15, 111, 255, 0.08) !important;
+    border-color: #0B5ED7 !important;
+    color: #0B5ED7 !important;
+}
+div[data-testid="stDownloadButton"] > button:active {
+    transform: translateY(1px);
+}
+</style>
+"""
+
 st.title("🏥 Medical Imaging Diagnosis Agent")
 
 # Patient info
@@ -216,23 +330,16 @@ if uploaded_file is not None:
 
 if uploaded_file is not None and medical_agent:
     try:
-        img = Image.open(uploaded_file).convert("RGB")
+        raw_bytes = uploaded_file.getvalue()
 
         # Optional lightweight enhancement
         enhance = st.toggle("Enhance image", value=True)
-        shown_img = enhance_image(img) if enhance else img
+        shown_img = load_enhanced_image(raw_bytes) if enhance else load_image(raw_bytes)
 
         st.image(shown_img, caption="Displayed Medical Image", use_container_width=True)
 
         if st.button("🔍 Analyze Image", type="primary", use_container_width=True):
             with st.spinner("🔄 Analyzing image..."):
-                # Save displayed image to a temp file (used for model + PDF)
-                with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-                    tmp_path = tmp.name
-                    shown_img.save(tmp_path)
-
-                agno_image = AgnoImage(filepath=tmp_path)
-
                 # Single-pass analysis (concise, structured markdown; small primary heading)
                 prompt = (
                     "You are a medical imaging expert. Analyze the attached image and write a concise, structured "
@@ -245,8 +352,33 @@ if uploaded_file is not None and medical_agent:
                     "5) References (2–3 items)\n"
                     "Be precise and avoid unsupported claims."
                 )
-                resp = medical_agent.run(prompt, images=[agno_image])
-                report_md = (resp.content or "").strip()
+
+                # Identical image + enhancement + prompt reuse the earlier report instead of
+                # calling the model again; the PDF is still rebuilt with current patient info
+                cache_key = (hashlib.sha256(raw_bytes).hexdigest(), enhance, prompt)
+                report_md = st.session_state.analysis_cache.get(cache_key)
+                # build_pdf_from_markdown fits the image itself; it is only pre-fitted
+                # below when there is a model call to overlap with
+                pdf_image = shown_img
+                if report_md is None:
+                    # Encode displayed image in memory for the model; it is discarded after
+                    # upload, so favour encode speed over size
+                    buf = io.BytesIO()
+                    shown_img.save(buf, format="PNG", compress_level=1)
+                    agno_image = AgnoImage(content=buf.getvalue(), format="png")
+
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        future = executor.submit(medical_agent.run, prompt, images=[agno_image])
+                        # Prepare PDF inputs while the model call is in flight
+                        pdf_image = fit_pdf_image(shown_img)
+                        for value in patient_info.values():
+                            sanitize_text(value)
+                        resp = future.result()
+                    report_md = (resp.content or "").strip()
+                    # Agent.run reports model failures as an error status rather than
+                    # raising; only cache real reports so the next click retries
+                    if report_md and resp.status != RunStatus.error:
+                        st.session_state.analysis_cache[cache_key] = report_md
 
                 # Show the same markdown in the UI
                 st.markdown("### 📋 Analysis Results")
@@ -256,7 +388,7 @@ if uploaded_file is not None and medical_agent:
                 st.caption("Note: AI-generated analysis. Please have a qualified clinician review.")
 
                 # Build a readable PDF from the same markdown, with the displayed image
-                pdf_bytes = build_pdf_from_markdown(patient_info, report_md, image_path=tmp_path)
+                pdf_bytes = build_pdf_from_markdown(patient_info, report_md, pil_image=pdf_image)
                 st.session_state.pdf_bytes = pdf_bytes
                 st.session_state.pdf_filename = (
                     f"report_{patient_info.get('name','patient')}_{patient_info.get('study_date','')}"
@@ -272,34 +404,14 @@ elif uploaded_file is None:
 
 # ---------------- Download Button (only after analysis) ----------------
 if st.session_state.pdf_bytes:
-    # Transparent hover style
-    st.markdown("""
-        <style>
-        div[data-testid="stDownloadButton"] > button {
-            background: transparent !important;
-            color: #0F6FFF !important;
-            border: 1px solid #0F6FFF !important;
-            border-radius: 6px;
-            padding: 0.5rem 1rem;
-            transition: background-color .2s ease, border-color .2s ease, color .2s ease, transform .05s ease;
-        }
-        div[data-testid="stDownloadButton"] > button:hover {
-            background: rgba(15, 111, 255, 0.08) !important;
-            border-color: #0B5ED7 !important;
-            color: #0B5ED7 !important;
-        }
-        div[data-testid="stDownloadButton"] > button:active {
-            transform: translateY(1px);
-        }
-        </style>
-    """, unsafe_allow_html=True)
+    # Transparent hover style (Streamlit rebuilds the page each rerun, so it is re-emitted)
+    st.markdown(DOWNLOAD_BUTTON_CSS, unsafe_allow_html=True)
 
     st.divider()
     st.subheader("📝 Download Report")
-    data_bytes = st.session_state.pdf_bytes if isinstance(st.session_state.pdf_bytes, bytes) else bytes(st.session_state.pdf_bytes)
     st.download_button(
         label="⬇️ Download PDF Report",
-        data=data_bytes,
+        data=st.session_state.pdf_bytes,
         file_name=f"{st.session_state.pdf_filename}.pdf",
         mime="application/pdf",
         use_container_width=True,